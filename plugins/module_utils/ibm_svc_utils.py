@@ -10,12 +10,38 @@ from __future__ import absolute_import, division, print_function
 
 __metaclass__ = type
 
+import base64
+import errno
+import gzip
+import io
 import json
 import logging
-
-from ansible.module_utils.urls import open_url
-from ansible.module_utils.six.moves.urllib.parse import quote
-from ansible.module_utils.six.moves.urllib.error import HTTPError
+import socket
+import ssl
+import threading
+
+from ansible.module_utils._text import to_text
+from ansible.module_utils.six.moves import http_client, queue
+from ansible.module_utils.six.moves.urllib.parse import quote, unquote, urlparse
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+
+# Signs that a keep-alive connection was closed by the server while idle.
+# The request never reached it, so it is safe to send it again.
+STALE_SEND_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+# Closed without a single byte of response
+REMOTE_DISCONNECTED = getattr(http_client, 'RemoteDisconnected',
+                              http_client.BadStatusLine)
+
+try:
+    import ijson
+    # use_float needs ijson >= 3.1, older releases would decode numbers
+    # as Decimal or reject the keyword
+    next(ijson.items(io.BytesIO(b'0'), '', use_float=True))
+    HAS_IJSON = True
+    JSON_ERRORS = (ValueError, ijson.JSONError)
+except (ImportError, TypeError):
+    HAS_IJSON = False
+    JSON_ERRORS = (ValueError,)
 
 
 def svc_argument_spec():
@@ -28,7 +54,7 @@ def svc_argument_spec():
     return dict(
         clustername=dict(type='str', required=True),
         domain=dict(type='str', default=None),
-        validate_certs=dict(type='bool', default=False),
+        validate_certs=dict(type='bool', default=True),
         username=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
         log_path=dict(type='str')
@@ -54,10 +80,19 @@ class IBMSVCRestApi(object):
     to use the RestApi we transform this into
     https://host:7443/rest/command/arg1/arg2/arg3
     data={'opt1':'value1', 'opt2':'value2'}
+
+    Every thread talks to the cluster over its own HTTP keep-alive
+    connection, so the TCP and TLS handshakes are paid once per thread
+    instead of once per command. The token obtained when connecting is
+    sent with every command and only renewed when the cluster rejects it,
+    so N commands cost 1 + N requests.
     """
 
+    # Same default as open_url
+    timeout = 10
+
     def __init__(self, module, clustername, domain, username, password,
-                 validate_certs, log_path):
+                 validate_certs, log_path, max_connections=1):
         """ Initialize module with what we need for initial connection
         :param clustername: name of the SVC cluster
         :type clustername: string
@@ -69,6 +104,9 @@ class IBMSVCRestApi(object):
         :type password: string
         :param validate_certs: whether or not the connection is insecure
         :type validate_certs: bool
+        :param max_connections: upper bound of concurrent connections used
+                                by svc_obj_info_iter
+        :type max_connections: int
         """
         self.module = module
         self.clustername = clustername
@@ -76,6 +114,19 @@ class IBMSVCRestApi(object):
         self.username = username
         self.password = password
         self.validate_certs = validate_certs
+        self.max_connections = max_connections
+
+        # Shared by all connections, the CA certificates are only loaded
+        # once.
+        if validate_certs:
+            self._ssl_context = ssl.create_default_context()
+        else:
+            self._ssl_context = ssl._create_unverified_context()
+
+        self._auth_lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
 
         # logging setup
         log = get_logger(self.__class__.__name__, log_path)
@@ -113,6 +164,159 @@ class IBMSVCRestApi(object):
     def token(self, value):
         return setattr(self, '_token', value)
 
+    def _svc_connection(self):
+        """ Return the keep-alive connection of the calling thread
+        :return: connection to the SVC RestApi
+        :rtype: http_client.HTTPConnection
+        """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            url = urlparse(self.resturl)
+            url_port = url.port or (443 if url.scheme == 'https' else 80)
+            proxy = self._svc_proxy(url)
+            if proxy:
+                host, port = proxy.hostname, proxy.port or 8080
+            else:
+                host, port = url.hostname, url_port
+            if url.scheme == 'https':
+                conn = http_client.HTTPSConnection(host, port,
+                                                   timeout=self.timeout,
+                                                   context=self._ssl_context)
+            else:
+                conn = http_client.HTTPConnection(host, port,
+                                                  timeout=self.timeout)
+            if proxy:
+                # Same environment variables as open_url, the proxy is
+                # asked to CONNECT to the cluster.
+                headers = {}
+                if proxy.username:
+                    credentials = '%s:%s' % (unquote(proxy.username),
+                                             unquote(proxy.password or ''))
+                    headers['Proxy-Authorization'] = 'Basic %s' % to_text(
+                        base64.b64encode(credentials.encode('utf-8')))
+                conn.set_tunnel(url.hostname, url_port, headers=headers)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _svc_proxy(self, url):
+        """ Find the proxy to reach the RestApi through
+        Honors the https_proxy, http_proxy and no_proxy environment
+        variables.
+        :param url: parsed RestApi url
+        :returns: parsed proxy url, or None to connect directly
+        """
+
+        proxy = getproxies().get(url.scheme)
+        if not proxy or proxy_bypass(url.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        return urlparse(proxy)
+
+    def _svc_disconnect(self):
+        """ Drop the connection of the calling thread """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close(self):
+        """ Close the connections opened by all threads """
+
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def _svc_load(self, o):
+        """ Decode a JSON response
+        When ijson is installed the document is decoded while it is being
+        received, so the raw body is never held in memory next to the
+        decoded objects.
+        :param o: http response
+        :type o: http_client.HTTPResponse
+        :return: decoded response, None if it is not valid JSON
+        """
+
+        try:
+            if HAS_IJSON:
+                return next(ijson.items(o, '', use_float=True))
+            return json.loads(to_text(o.read()))
+        except JSON_ERRORS as e:
+            self.log("_svc_rest: value error pass: %s", e)
+            return None
+
+    def _svc_request(self, method, url, headers, data, load=None):
+        """ Send a request over the keep-alive connection of this thread
+        The server may close an idle connection at any time; in that case
+        the request is retried once over a fresh connection. Requests are
+        never retried once the server may have received them, e.g. after
+        a read timeout or a partial response.
+        :param method: http method, POST or GET
+        :type method: string
+        :param url: full url of the request
+        :type url: string
+        :param headers: http headers
+        :type headers: dict
+        :param data: request body
+        :type data: bytes
+        :param load: decodes the body of a successful response, which is
+                     returned raw if None
+        :type load: callable
+        :return: status, reason and body of the response
+        :rtype: tuple
+        """
+
+        headers = dict(headers)
+        headers['Connection'] = 'keep-alive'
+        # Same default as open_url
+        headers['User-Agent'] = 'ansible-httpget'
+        # Listings are very repetitive and compress well
+        headers['Accept-Encoding'] = 'gzip'
+        path = urlparse(url).path
+
+        while True:
+            conn = self._svc_connection()
+            reused = conn.sock is not None
+            stale = False
+            try:
+                try:
+                    conn.request(method, path, body=data, headers=headers)
+                except socket.error as e:
+                    stale = e.errno in STALE_SEND_ERRNOS
+                    raise
+                try:
+                    o = conn.getresponse()
+                except REMOTE_DISCONNECTED:
+                    stale = True
+                    raise
+                # From here on the server has seen the request, which must
+                # never be sent twice: commands such as mkvdisk are not
+                # idempotent.
+                stream = o
+                if (o.getheader('Content-Encoding') or '').lower() == 'gzip':
+                    # Decompressed as it is read, so that decoding
+                    # overlaps with the transfer.
+                    stream = gzip.GzipFile(fileobj=o, mode='rb')
+                if load is None or o.status >= 400:
+                    body = stream.read()
+                    o.read()
+                    return o.status, o.reason, body
+                body = load(stream)
+                # Drain what the decoder left, for the next request
+                o.read()
+                return o.status, o.reason, body
+            except (http_client.HTTPException, socket.error):
+                self._svc_disconnect()
+                if not (reused and stale):
+                    raise
+                self.log('_svc_rest: stale connection, reconnecting')
+
     def _svc_rest(self, method, headers, cmd, cmdopts, cmdargs):
         """ Run SVC command with token info added into header
         :param method: http method, POST or GET
@@ -150,27 +354,25 @@ class IBMSVCRestApi(object):
         self.log("_svc_rest: payload=%s", payload)
 
         try:
-            o = open_url(url, method=method, headers=headers,
-                         validate_certs=self.validate_certs, data=bytes(data))
-        except HTTPError as e:
-            self.log('_svc_rest: httperror %s', str(e))
-            r['code'] = e.getcode()
-            r['out'] = e.read()
-            r['err'] = "HTTPError %s", str(e)
-            return r
+            status, reason, body = self._svc_request(method, url, headers,
+                                                     bytes(data),
+                                                     load=self._svc_load)
         except Exception as e:
-            self.log('_svc_rest: exception : %s', str(e))
-            r['err'] = "Exception %s", str(e)
+            self.log('_svc_rest: exception : %s', e)
+            r['err'] = "Exception %s" % str(e)
             return r
 
-        try:
-            j = json.load(o)
-        except ValueError as e:
-            self.log("_svc_rest: value error pass: %s", str(e))
-            # pass, will mean both data and error are None.
+        if status >= 400:
+            e = 'HTTP Error %d: %s' % (status, reason)
+            self.log('_svc_rest: httperror %s', e)
+            r['code'] = status
+            r['out'] = body
+            r['err'] = "HTTPError %s" % e
             return r
 
-        r['out'] = j
+        # None if the body was not valid JSON, both data and error are
+        # None then.
+        r['out'] = body
         return r
 
     def _svc_authorize(self):
@@ -208,18 +410,52 @@ class IBMSVCRestApi(object):
         :returns: command results
         """
 
-        if self.token is None:
-            self.module.fail_json(msg="No authorize token")
-            # Abort
+        token = self.token
+        if token is None:
+            # May run in a svc_obj_info_iter worker, where fail_json must
+            # not be called: the caller reports the error.
+            return {
+                'url': None,
+                'code': None,
+                'err': 'No authorize token',
+                'out': None,
+                'data': cmdopts
+            }
 
         headers = {
             'Content-Type': 'application/json',
-            'X-Auth-Token': self.token
+            'X-Auth-Token': token
         }
 
-        return self._svc_rest(method='POST', headers=headers, cmd=cmd,
+        rest = self._svc_rest(method='POST', headers=headers, cmd=cmd,
                               cmdopts=cmdopts, cmdargs=cmdargs)
 
+        if rest['code'] == 401:
+            # Token expired, authorize again and retry once
+            token = self._svc_reauthorize(token)
+            if token:
+                headers['X-Auth-Token'] = token
+                rest = self._svc_rest(method='POST', headers=headers,
+                                      cmd=cmd, cmdopts=cmdopts,
+                                      cmdargs=cmdargs)
+
+        return rest
+
+    def _svc_reauthorize(self, expired):
+        """ Replace an expired token
+        Several threads may find out at the same time, only the first one
+        obtains a new token.
+        :param expired: token rejected by the server
+        :type expired: string
+        :return: None or token string
+        """
+
+        with self._auth_lock:
+            if self.token == expired:
+                self.log("_svc_reauthorize: token expired")
+                self.token = self._svc_authorize()
+            return self.token
+
     def svc_run_command(self, cmd, cmdopts, cmdargs):
         """ Generic execute a SVC command
         :param cmd: svc command to run
@@ -255,6 +491,74 @@ class IBMSVCRestApi(object):
         """
 
         rest = self._svc_token_wrap(cmd, cmdopts, cmdargs)
+        return self._svc_obj_info_out(rest)
+
+    def svc_obj_info_iter(self, cmds):
+        """ Obtain information about several SVC objects via ls commands
+        The RestApi has no endpoint taking several commands at once, so
+        the batch is run client side. The requests are issued by up to
+        max_connections background threads, each of them reusing its
+        keep-alive connection for several commands. The calling thread
+        only receives the outputs, so even with a single connection it
+        processes one while the next one is still on the wire.
+        :param cmds: svc commands to run, without options or arguments;
+                     a command listed several times is run once
+        :type cmds: list
+        :returns: (command, command output) pairs, in completion order
+        :rtype: generator
+        """
+
+        pending = queue.Queue()
+        done = queue.Queue()
+        seen = set()
+        for cmd in cmds:
+            if cmd not in seen:
+                seen.add(cmd)
+                pending.put(cmd)
+
+        def worker(conn):
+            if conn is not None:
+                self._local.conn = conn
+            while True:
+                try:
+                    cmd = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    rest = self._svc_token_wrap(cmd, None, None)
+                except Exception as e:
+                    # The calling thread waits for one result per command,
+                    # a worker dying silently would hang it.
+                    rest = {'url': None, 'code': None,
+                            'err': 'Exception %s' % e, 'out': None,
+                            'data': None}
+                done.put((cmd, rest))
+
+        # The first worker takes over the connection used to authorize,
+        # rather than leaving it idle and opening another one.
+        conn = getattr(self._local, 'conn', None)
+        for i in range(min(len(seen), self.max_connections)):
+            if i == 0:
+                self._local.conn = None
+            t = threading.Thread(target=worker, args=(conn,))
+            t.daemon = True
+            t.start()
+            conn = None
+
+        for i in range(len(seen)):
+            cmd, rest = done.get()
+            # Errors are only reported from the calling thread, fail_json
+            # must never run in a worker.
+            yield cmd, self._svc_obj_info_out(rest)
+
+    def _svc_obj_info_out(self, rest):
+        """ Check the result of an ls command
+        :param rest: result of _svc_token_wrap
+        :type rest: dict
+        :returns: command output
+        :rtype: dict
+        """
+
         self.log("svc_obj_info rest=%s", rest)
 
         if rest['code']:
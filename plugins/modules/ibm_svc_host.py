@@ -95,6 +95,7 @@ options:
         description:
             - Validate certification
         type: bool
+        default: true
 author:
     - Peng Wang (@wangpww)
 '''
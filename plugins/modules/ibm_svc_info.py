@@ -67,6 +67,7 @@ options:
     description:
     - Validate certification
     type: bool
+    default: true
   gather_subset:
     type: list
     required: False
@@ -97,6 +98,40 @@ options:
               , iscsiport, fcmap, fc, fcconsistgrp
               , vdiskcopy, 'targetportfc', array, system, all]
     default: "all"
+  cache_ttl:
+    type: int
+    required: False
+    description:
+    - Number of seconds the output of each ls command is cached on the
+      Ansible controller, so that tasks gathering overlapping subsets
+      from the same storage system within that time do not query it again.
+    - The cache is kept below the system temporary directory, in a
+      directory only the current user can access. It is not used if
+      that directory is owned by another user or accessible to others.
+    - When every requested listing is cached, the storage system is not
+      contacted at all.
+    - 0 disables the cache.
+    default: 0
+  max_connections:
+    type: int
+    required: False
+    description:
+    - Number of listings requested from the storage system at the same
+      time.
+    - Each listing is processed while the next one is being received,
+      whatever this value.
+    - Large listings use a lot of memory on the storage system, raise
+      it with care, see the Limitation section of the collection README.
+    default: 1
+  fields:
+    type: dict
+    required: False
+    description:
+    - "Columns to return for each gather_subset entry, for example
+      C({vol: [id, name, capacity, mdisk_grp_name]})."
+    - The storage system always returns all the columns of a listing;
+      the others are dropped before the result is returned.
+    - Entries not listed return all their columns.
 '''
 
 EXAMPLES = '''
@@ -139,13 +174,61 @@ EXAMPLES = '''
 RETURN = '''
 '''
 
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
 from traceback import format_exc
 from ansible.module_utils.basic import AnsibleModule
 from ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.ibm_svc_utils import IBMSVCRestApi, svc_argument_spec, get_logger
 from ansible.module_utils._text import to_native
+from ansible.module_utils.six import string_types
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 
 class IBMSVCGatherInfo(object):
+    # gather_subset entry -> (ls command, exit_json key)
+    _SUBSETS = {
+        'vol': ('lsvdisk', 'Volumes'),
+        'pool': ('lsmdiskgrp', 'Pools'),
+        'node': ('lsnode', 'Nodes'),
+        'iog': ('lsiogrp', 'IOGroup'),
+        'host': ('lshost', 'Hosts'),
+        'hc': ('lshostcluster', 'HostClusters'),
+        'fc': ('lsfabric', 'FCConnectivity'),
+        'fcport': ('lsportfc', 'FCPorts'),
+        'targetportfc': ('lstargetportfc', 'TargetPortFC'),
+        'iscsiport': ('lsportip', 'iSCSIPorts'),
+        'fcmap': ('lsfcmap', 'FCMaps'),
+        'fcconsistgrp': ('lsfcconsistgrp', 'FCConsistgrp'),
+        'vdiskcopy': ('lsvdiskcopy', 'VdiskCopy'),
+        'array': ('lsarray', 'Array'),
+        'system': ('lssystem', 'System'),
+    }
+    # Fixed plan for gather_subset=all, built once
+    _ALL_CMDS = tuple(sorted(cmd for cmd, label in _SUBSETS.values()))
+    _CMD_KEYS = dict((cmd, key) for key, (cmd, label) in _SUBSETS.items())
+
+    # Columns with few distinct values, repeated on most rows of large
+    # listings. Equal values are made to share a single string object.
+    _INTERN_KEYS = frozenset([
+        'status', 'type', 'protocol', 'sync', 'autoexpand', 'se_copy',
+        'fast_write_state', 'formatting', 'encrypt', 'RC_change',
+        'mdisk_grp_id', 'mdisk_grp_name', 'parent_mdisk_grp_id',
+        'parent_mdisk_grp_name', 'IO_group_id', 'IO_group_name',
+        'node_id', 'node_name', 'owner_id', 'owner_name', 'site_id',
+        'site_name', 'host_cluster_id', 'host_cluster_name', 'port_speed',
+        'port_status', 'copy_count', 'fc_map_count', 'se_copy_count',
+        'compressed_copy_count', 'function',
+    ])
+
     def __init__(self):
         argument_spec = svc_argument_spec()
 
@@ -155,317 +238,262 @@ class IBMSVCGatherInfo(object):
                 state=dict(type='str', default='info', choices=['info']),
                 gather_subset=dict(type='list', required=False,
                                    default=['all'],
-                                   choices=['vol',
-                                            'pool',
-                                            'node',
-                                            'iog',
-                                            'host',
-                                            'hc',
-                                            'fc',
-                                            'fcport',
-                                            'targetportfc',
-                                            'iscsiport',
-                                            'fcmap',
-                                            'fcconsistgrp',
-                                            'vdiskcopy',
-                                            'array',
-                                            'system',
-                                            'all'
-                                            ]),
+                                   choices=list(self._SUBSETS) + ['all']),
+                cache_ttl=dict(type='int', default=0),
+                max_connections=dict(type='int', default=1),
+                fields=dict(type='dict', default={}),
             )
         )
 
         self.module = AnsibleModule(argument_spec=argument_spec,
                                     supports_check_mode=True)
+        if HAS_ORJSON:
+            # The gathered lists can be large, orjson encodes them several
+            # times faster than the json module used by AnsibleModule.
+            self._std_jsonify = self.module.jsonify
+            self.module.jsonify = self._jsonify
 
         # logging setup
         log_path = self.module.params['log_path']
         self.log = get_logger(self.__class__.__name__, log_path)
         self.name = self.module.params['name']
-
-        self.restapi = IBMSVCRestApi(
-            module=self.module,
-            clustername=self.module.params['clustername'],
-            domain=self.module.params['domain'],
-            username=self.module.params['username'],
-            password=self.module.params['password'],
-            validate_certs=self.module.params['validate_certs'],
-            log_path=log_path
-        )
-
-    def get_volumes_list(self):
-        try:
-            vols = self.restapi.svc_obj_info(cmd='lsvdisk', cmdopts=None,
-                                             cmdargs=None)
-            self.log.info("Successfully listed %d volumes from array %s",
-                          len(vols), self.module.params['clustername'])
-            return vols
-        except Exception as e:
-            msg = ('Get Volumes from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_pools_list(self):
-        try:
-            pools = self.restapi.svc_obj_info(cmd='lsmdiskgrp', cmdopts=None,
-                                              cmdargs=None)
-            self.log.info('Successfully listed %d pools from array '
-                          '%s', len(pools), self.module.params['clustername'])
-            return pools
-        except Exception as e:
-            msg = ('Get Pools from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_nodes_list(self):
-        try:
-            nodes = self.restapi.svc_obj_info(cmd='lsnode', cmdopts=None,
-                                              cmdargs=None)
-            self.log.info('Successfully listed %d pools from array %s',
-                          len(nodes), self.module.params['clustername'])
-            return nodes
-        except Exception as e:
-            msg = ('Get Nodes from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_hosts_list(self):
-        try:
-            hosts = self.restapi.svc_obj_info(cmd='lshost', cmdopts=None,
-                                              cmdargs=None)
-            self.log.info('Successfully listed %d hosts from array '
-                          '%s', len(hosts), self.module.params['clustername'])
-            return hosts
-        except Exception as e:
-            msg = ('Get Hosts from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_iogroups_list(self):
-        try:
-            iogrps = self.restapi.svc_obj_info(cmd='lsiogrp', cmdopts=None,
-                                               cmdargs=None)
-            self.log.info('Successfully listed %d hosts from array '
-                          '%s', len(iogrps), self.module.params['clustername'])
-            return iogrps
-        except Exception as e:
-            msg = ('Get IO Groups from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_host_clusters_list(self):
-        try:
-            hcs = self.restapi.svc_obj_info(cmd='lshostcluster', cmdopts=None,
-                                            cmdargs=None)
-            self.log.info('Successfully listed %d host clusters from array '
-                          '%s', len(hcs), self.module.params['clustername'])
-            return hcs
-        except Exception as e:
-            msg = ('Get Host Cluster from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_fc_connectivity_list(self):
-        try:
-            fc = self.restapi.svc_obj_info(cmd='lsfabric', cmdopts=None,
-                                           cmdargs=None)
-            self.log.info('Successfully listed %d fc connectivity from array '
-                          '%s', len(fc), self.module.params['clustername'])
-            return fc
-        except Exception as e:
-            msg = ('Get FC Connectivity from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_fc_ports_list(self):
-        try:
-            fcports = self.restapi.svc_obj_info(cmd='lsportfc', cmdopts=None,
-                                                cmdargs=None)
-            self.log.info('Successfully listed %d fc ports from array %s',
-                          len(fcports), self.module.params['clustername'])
-            return fcports
-        except Exception as e:
-            msg = ('Get fc ports from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_target_port_fc_list(self):
-        try:
-            targetportfc = self.restapi.svc_obj_info(cmd='lstargetportfc',
-                                                     cmdopts=None,
-                                                     cmdargs=None)
-            self.log.info('Successfully listed %d target port fc '
-                          'from array %s', len(targetportfc),
-                          self.module.params['clustername'])
-            return targetportfc
-        except Exception as e:
-            msg = ('Get target port fc from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_iscsi_ports_list(self):
-        try:
-            ipports = self.restapi.svc_obj_info(cmd='lsportip', cmdopts=None,
-                                                cmdargs=None)
-            self.log.info('Successfully listed %d iscsi ports from array %s',
-                          len(ipports), self.module.params['clustername'])
-            return ipports
-        except Exception as e:
-            msg = ('Get iscsi ports from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_fc_map_list(self):
-        try:
-            fcmaps = self.restapi.svc_obj_info(cmd='lsfcmap', cmdopts=None,
-                                               cmdargs=None)
-            self.log.info('Successfully listed %d fc maps from array %s',
-                          len(fcmaps), self.module.params['clustername'])
-            return fcmaps
-        except Exception as e:
-            msg = ('Get fc maps from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_array_list(self):
-        try:
-            array = self.restapi.svc_obj_info(cmd='lsarray', cmdopts=None,
-                                              cmdargs=None)
-            self.log.info('Successfully listed %d array info from array %s',
-                          len(array), self.module.params['clustername'])
-            return array
-        except Exception as e:
-            msg = ('Get Array info from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
-
-    def get_system_list(self):
+        self.clustername = self.module.params['clustername']
+        self.cache_ttl = self.module.params['cache_ttl']
+        if self.cache_ttl < 0:
+            self.module.fail_json(msg='cache_ttl must be at least 0')
+        self.max_connections = self.module.params['max_connections']
+        if self.max_connections < 1:
+            self.module.fail_json(msg='max_connections must be at least 1')
+        self.fields = self.module.params['fields'] or {}
+        unknown = set(self.fields) - set(self._SUBSETS)
+        if unknown:
+            self.module.fail_json(msg='Unsupported fields entries: %s' %
+                                  ', '.join(sorted(unknown)))
+        invalid = [k for k, v in self.fields.items()
+                   if not isinstance(v, list)
+                   or not all(isinstance(c, string_types) for c in v)]
+        if invalid:
+            self.module.fail_json(msg='fields entries must be lists of column '
+                                  'names: %s' % ', '.join(sorted(invalid)))
+        # One root per local user, only ever used when it is private
+        self.cache_root = os.path.join(
+            tempfile.gettempdir(), 'ibm_svc_info_cache-%d' % os.getuid())
+        self.cache_dir = os.path.join(
+            self.cache_root,
+            hashlib.sha1('{0}|{1}|{2}'.format(
+                self.clustername, self.module.params['domain'],
+                self.module.params['username']).encode('utf-8')).hexdigest())
+
+        self.log_path = log_path
+        self._restapi = None
+
+    @property
+    def restapi(self):
+        """ REST client, connected on first use so that runs served from
+        the cache do not authorize at all """
+        if self._restapi is None:
+            self._restapi = IBMSVCRestApi(
+                module=self.module,
+                clustername=self.clustername,
+                domain=self.module.params['domain'],
+                username=self.module.params['username'],
+                password=self.module.params['password'],
+                validate_certs=self.module.params['validate_certs'],
+                log_path=self.log_path,
+                max_connections=self.max_connections
+            )
+        return self._restapi
+
+    def _jsonify(self, data):
+        """ Encode data with orjson, AnsibleModule.jsonify replacement
+        :param data: data to encode
+        :returns: JSON document
+        :rtype: str
+        """
         try:
-            system = self.restapi.svc_obj_info(cmd='lssystem', cmdopts=None,
-                                               cmdargs=None)
-            self.log.info('Successfully listed %d system info from array %s',
-                          len(system), self.module.params['clustername'])
-            return system
-        except Exception as e:
-            msg = ('Get System info from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
+            return orjson.dumps(data).decode('utf-8')
+        except TypeError:
+            # Types only the json module knows about, such as sets
+            return self._std_jsonify(data)
+
+    def _cache_private(self, create=False):
+        """ Check that only the current user can access the cache
+        Other local users could otherwise plant entries in a directory
+        with a predictable name.
+        :param create: create the missing directories
+        :type create: bool
+        :returns: whether the cache can be used
+        :rtype: bool
+        """
+        for path in (self.cache_root, self.cache_dir):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                if not create:
+                    return False
+                try:
+                    os.mkdir(path, 0o700)
+                    st = os.lstat(path)
+                except OSError as e:
+                    self.log.warning("Failed to create cache %s: %s",
+                                     path, e)
+                    return False
+            if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+                    or st.st_mode & 0o077):
+                self.log.warning("Not using cache %s, it is not private "
+                                 "to the current user", path)
+                return False
+        return True
+
+    def _cache_read(self, cmds):
+        """ Load the cached output of the given commands
+        :param cmds: svc commands
+        :type cmds: list
+        :returns: output of the commands cached less than cache_ttl
+                  seconds ago
+        :rtype: dict
+        """
+        outs = {}
+        if not self.cache_ttl or not self._cache_private():
+            return outs
+
+        now = time.time()
+        for cmd in cmds:
+            path = os.path.join(self.cache_dir, cmd + '.json')
+            try:
+                if now - os.path.getmtime(path) < self.cache_ttl:
+                    with open(path) as f:
+                        outs[cmd] = json.load(f)
+                    self.log.info("Using cached %s from %s", cmd, path)
+            except (IOError, OSError, ValueError):
+                # Missing or unreadable, fetch it again
+                pass
+        return outs
+
+    def _cache_write(self, outs):
+        """ Cache the output of commands, if caching is enabled
+        :param outs: output of each command
+        :type outs: dict
+        """
+        if not self.cache_ttl or not self._cache_private(create=True):
+            return
 
-    def get_fcconsistgrp_list(self):
         try:
-            fcconsistgrp = self.restapi.svc_obj_info(cmd='lsfcconsistgrp',
-                                                     cmdopts=None,
-                                                     cmdargs=None)
-            self.log.info('Successfully listed %d fcconsistgrp info '
-                          'from array %s', len(fcconsistgrp),
-                          self.module.params['clustername'])
-            return fcconsistgrp
-        except Exception as e:
-            msg = ('Get fcconsistgrp info from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
+            for cmd, out in outs.items():
+                fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(out, f)
+                    # Atomic, readers never see a partial file
+                    os.rename(tmp, os.path.join(self.cache_dir,
+                                                cmd + '.json'))
+                except Exception:
+                    os.unlink(tmp)
+                    raise
+        except (IOError, OSError, TypeError, ValueError) as e:
+            self.log.warning("Failed to cache results in %s: %s",
+                             self.cache_dir, str(e))
+
+    def _project(self, out, columns):
+        """ Keep only the given columns of the output of an ls command
+        :param out: output of an ls command
+        :type out: list or dict
+        :param columns: columns to keep
+        :type columns: list
+        :returns: projected output
+        :rtype: list or dict
+        """
+        if isinstance(out, dict):
+            return dict((c, out[c]) for c in columns if c in out)
+        if isinstance(out, list):
+            return [self._project(row, columns) for row in out]
+        return out
+
+    def _intern_rows(self, out, interned):
+        """ Share equal values of the _INTERN_KEYS columns between rows
+        :param out: output of an ls command, updated in place
+        :type out: list or dict
+        :param interned: value -> shared string, kept across commands
+        :type interned: dict
+        """
+        rows = out if isinstance(out, list) else [out]
+        for row in rows:
+            if not isinstance(row, dict):
+                continue
+            for k in self._INTERN_KEYS.intersection(row):
+                v = row[k]
+                if isinstance(v, string_types):
+                    row[k] = interned.setdefault(v, v)
+
+    def _fetch(self, cmds):
+        """ Run the ls commands of gather_subset entries
+        :param cmds: ls commands, from _SUBSETS
+        :type cmds: list
+        :returns: command output for each exit_json key
+        :rtype: dict
+        """
+        outs = self._cache_read(cmds)
+        missing = [cmd for cmd in cmds if cmd not in outs]
+
+        result = {}
+        interned = {}
+        for cmd, out in outs.items():
+            self._add_result(result, self._CMD_KEYS[cmd], out, interned)
 
-    def get_vdiskcopy_list(self):
         try:
-            vdiskcopy = self.restapi.svc_obj_info(cmd='lsvdiskcopy',
-                                                  cmdopts=None,
-                                                  cmdargs=None)
-            self.log.info('Successfully listed %d vdiskcopy info '
-                          'from array %s', len(vdiskcopy),
-                          self.module.params['clustername'])
-            return vdiskcopy
+            if missing:
+                for cmd, out in self.restapi.svc_obj_info_iter(missing):
+                    # A failed listing must not be replayed from the cache
+                    if out is not None:
+                        self._cache_write({cmd: out})
+                    self._add_result(result, self._CMD_KEYS[cmd], out,
+                                     interned)
         except Exception as e:
-            msg = ('Get vdiskcopy info from array %s failed with error %s ',
-                   self.module.params['clustername'], str(e))
-            self.log.error(msg)
-            self.module.fail_json(msg=msg)
+            self.log.error("Get %s from array %s failed with error %s",
+                           ', '.join(missing), self.clustername, e)
+            self.module.fail_json(
+                msg='Get %s from array %s failed with error %s' % (
+                    ', '.join(missing), self.clustername, to_native(e)))
+        finally:
+            if self._restapi is not None:
+                self._restapi.close()
+
+        return result
+
+    def _add_result(self, result, key, out, interned):
+        """ Add the output of the ls command of a gather_subset entry
+        :param result: exit_json key -> command output, updated in place
+        :type result: dict
+        :param key: gather_subset entry
+        :type key: string
+        :param out: output of the ls command
+        :type out: list or dict
+        :param interned: interned values, see _intern_rows
+        :type interned: dict
+        """
+        label = self._SUBSETS[key][1]
+        if self.fields.get(key):
+            out = self._project(out, self.fields[key])
+        self._intern_rows(out, interned)
+        result[label] = out
+        self.log.info("Successfully listed %d %s from array %s",
+                      len(out), label, self.clustername)
 
     def apply(self):
 
         subset = self.module.params['gather_subset']
-        if len(subset) == 0 or 'all' in subset:
+        if not subset or 'all' in subset:
             self.log.info("The default value for gather_subset is all")
-            subset = ['vol', 'pool', 'node', 'iog', 'host', 'hc', 'fc',
-                      'fcport', 'iscsiport', 'fcmap', 'fcconsistgrp',
-                      'vdiskcopy', 'targetportfc', 'array', 'system']
-
-        vol = []
-        pool = []
-        node = []
-        iog = []
-        host = []
-        hc = []
-        fc = []
-        fcport = []
-        targetportfc = []
-        iscsiport = []
-        fcmap = []
-        fcconsistgrp = []
-        vdiskcopy = []
-        array = []
-        system = []
-
-        if 'vol' in subset:
-            vol = self.get_volumes_list()
-        if 'pool' in subset:
-            pool = self.get_pools_list()
-        if 'node' in subset:
-            node = self.get_nodes_list()
-        if 'iog' in subset:
-            iog = self.get_iogroups_list()
-        if 'host' in subset:
-            host = self.get_hosts_list()
-        if 'hc' in subset:
-            hc = self.get_host_clusters_list()
-        if 'fc' in subset:
-            fc = self.get_fc_connectivity_list()
-        if 'targetportfc' in subset:
-            targetportfc = self.get_target_port_fc_list()
-        if 'fcport' in subset:
-            fcport = self.get_fc_ports_list()
-        if 'iscsiport' in subset:
-            iscsiport = self.get_iscsi_ports_list()
-        if 'fcmap' in subset:
-            fcmap = self.get_fc_map_list()
-        if 'fcconsistgrp' in subset:
-            fcconsistgrp = self.get_fcconsistgrp_list()
-        if 'vdiskcopy' in subset:
-            vdiskcopy = self.get_vdiskcopy_list()
-        if 'array' in subset:
-            array = self.get_array_list()
-        if 'system' in subset:
-            system = self.get_system_list()
-
-        self.module.exit_json(
-            Volumes=vol,
-            Pools=pool,
-            Nodes=node,
-            IOGroup=iog,
-            Hosts=host,
-            HostClusters=hc,
-            FCConnectivity=fc,
-            FCConsistgrp=fcconsistgrp,
-            VdiskCopy=vdiskcopy,
-            FCPorts=fcport,
-            TargetPortFC=targetportfc,
-            iSCSIPorts=iscsiport,
-            FCMaps=fcmap,
-            Array=array,
-            System=system)
+            # Every exit_json key gets filled, no defaults needed
+            result = self._fetch(self._ALL_CMDS)
+        else:
+            # Only _SUBSETS keys get past the gather_subset choices
+            cmds = [self._SUBSETS[k][0] for k in frozenset(subset)]
+            result = dict((label, [])
+                          for cmd, label in self._SUBSETS.values())
+            result.update(self._fetch(cmds))
+
+        self.module.exit_json(**result)
 
 
 def main():
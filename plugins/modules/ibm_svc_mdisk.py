@@ -68,6 +68,7 @@ options:
     description:
       - Validate certification
     type: bool
+    default: true
   level:
     description:
       - level
@@ -81,6 +81,7 @@ options:
     description:
       - Validate certification
     type: bool
+    default: true
   parentmdiskgrp:
     description:
       - parentmdiskgrp for subpool
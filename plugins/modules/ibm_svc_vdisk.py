@@ -78,6 +78,7 @@ options:
     description:
     - Validate certification
     type: bool
+    default: true
   log_path:
     description:
     - Debugs log for this file
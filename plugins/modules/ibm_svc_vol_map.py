@@ -68,6 +68,7 @@ options:
     description:
     - Validate certification
     type: bool
+    default: true
 author:
     - Peng Wang(@wangpww)
 '''
@@ -11,11 +11,14 @@ __metaclass__ = type
 import unittest
 import pytest
 import json
+import os
+import shutil
+import tempfile
 from mock import patch
 from ansible.module_utils import basic
 from ansible.module_utils._text import to_bytes
 from ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.ibm_svc_utils import IBMSVCRestApi
-from ansible_collections.ibm.spectrum_virtualize.plugins.modules.ibm_svc_info import IBMSVCGatherInfo
+from ansible_collections.ibm.spectrum_virtualize.plugins.modules.ibm_svc_info import IBMSVCGatherInfo, HAS_ORJSON
 
 
 def set_module_args(args):
@@ -80,12 +83,12 @@ class TestIBMSVCGatherInfo(unittest.TestCase):
             IBMSVCGatherInfo()
         print('Info: %s' % exc.value.args[0]['msg'])
 
-    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.modules.'
-           'ibm_svc_info.IBMSVCGatherInfo.get_hosts_list')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
            'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
     def test_get_host_list_called(self, mock_svc_authorize,
-                                  get_hosts_list_mock):
+                                  svc_obj_info_iter_mock):
         set_module_args({
             'clustername': 'clustername',
             'domain': 'domain',
@@ -95,23 +98,18 @@ class TestIBMSVCGatherInfo(unittest.TestCase):
             'password': 'password',
             'gather_subset': 'host',
         })
+        svc_obj_info_iter_mock.return_value = [('lshost', [])]
         with pytest.raises(AnsibleExitJson) as exc:
             IBMSVCGatherInfo().apply()
         self.assertFalse(exc.value.args[0]['changed'])
-        get_hosts_list_mock.assert_called_with()
+        svc_obj_info_iter_mock.assert_called_with(['lshost'])
 
-    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.modules.'
-           'ibm_svc_info.IBMSVCGatherInfo.get_pools_list')
-    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.modules.'
-           'ibm_svc_info.IBMSVCGatherInfo.get_volumes_list')
-    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.modules.'
-           'ibm_svc_info.IBMSVCGatherInfo.get_hosts_list')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
            'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
     def test_get_pool_vol_host_list_called(self, mock_svc_authorize,
-                                           get_hosts_list_mock,
-                                           get_volumes_list_mock,
-                                           get_pools_list_mock):
+                                           svc_obj_info_iter_mock):
         set_module_args({
             'clustername': 'clustername',
             'domain': 'domain',
@@ -121,19 +119,21 @@ class TestIBMSVCGatherInfo(unittest.TestCase):
             'password': 'password',
             'gather_subset': 'pool,host,vol',
         })
+        svc_obj_info_iter_mock.return_value = [('lshost', []),
+                                               ('lsvdisk', []),
+                                               ('lsmdiskgrp', [])]
         with pytest.raises(AnsibleExitJson) as exc:
             IBMSVCGatherInfo().apply()
-            get_hosts_list_mock.assert_called_with()
-            get_pools_list_mock.assert_called_with()
-            get_volumes_list_mock.assert_called_with()
         self.assertFalse(exc.value.args[0]['changed'])
+        cmds = svc_obj_info_iter_mock.call_args[0][0]
+        self.assertEqual(sorted(cmds), ['lshost', 'lsmdiskgrp', 'lsvdisk'])
 
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
-           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info')
+           'ibm_svc_utils.IBMSVCRestApi._svc_token_wrap')
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
            'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
     def test_the_host_result_by_gather_info(self, svc_authorize_mock,
-                                            svc_obj_info_mock):
+                                            svc_token_wrap_mock):
         set_module_args({
             'clustername': 'clustername',
             'domain': 'domain',
@@ -149,18 +149,19 @@ class TestIBMSVCGatherInfo(unittest.TestCase):
                      "host_cluster_id": "", "host_cluster_name": "",
                      "protocol": "nvme", "owner_id": "",
                      "owner_name": ""}]
-        svc_obj_info_mock.return_value = host_ret
+        svc_token_wrap_mock.return_value = {'out': host_ret, 'code': None,
+                                            'err': None}
         with pytest.raises(AnsibleExitJson) as exc:
             IBMSVCGatherInfo().apply()
         self.assertFalse(exc.value.args[0]['changed'])
         self.assertDictEqual(exc.value.args[0]['Hosts'][0], host_ret[0])
 
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
-           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info')
+           'ibm_svc_utils.IBMSVCRestApi._svc_token_wrap')
     @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
            'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
     def test_the_host_and_vol_result_by_gather_info(self, svc_authorize_mock,
-                                                    svc_obj_info_mock):
+                                                    svc_token_wrap_mock):
         set_module_args({
             'clustername': 'clustername',
             'domain': 'domain',
@@ -192,13 +193,260 @@ class TestIBMSVCGatherInfo(unittest.TestCase):
                     "encrypt": "no", "volume_id": "0",
                     "volume_name": "volume_Ansible_collections",
                     "function": "", "protocol": "scsi"}]
-        svc_obj_info_mock.side_effect = [vol_ret, host_ret]
+        rets = {'lshost': host_ret, 'lsvdisk': vol_ret}
+        svc_token_wrap_mock.side_effect = lambda cmd, cmdopts, cmdargs: {
+            'out': rets[cmd], 'code': None, 'err': None}
         with pytest.raises(AnsibleExitJson) as exc:
             IBMSVCGatherInfo().apply()
         self.assertFalse(exc.value.args[0]['changed'])
         self.assertDictEqual(exc.value.args[0]['Hosts'][0], host_ret[0])
         self.assertDictEqual(exc.value.args[0]['Volumes'][0], vol_ret[0])
 
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_get_all_list_called(self, svc_authorize_mock,
+                                 svc_obj_info_iter_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_get_all_list_called',
+            'username': 'username',
+            'password': 'password',
+            'gather_subset': 'all',
+        })
+        svc_obj_info_iter_mock.side_effect = lambda cmds: [
+            (cmd, [{'cmd': cmd}]) for cmd in cmds]
+        with pytest.raises(AnsibleExitJson) as exc:
+            IBMSVCGatherInfo().apply()
+        self.assertEqual(len(svc_obj_info_iter_mock.call_args[0][0]), 15)
+        self.assertEqual(exc.value.args[0]['Volumes'], [{'cmd': 'lsvdisk'}])
+        self.assertEqual(exc.value.args[0]['System'], [{'cmd': 'lssystem'}])
+        self.assertEqual(exc.value.args[0]['FCPorts'], [{'cmd': 'lsportfc'}])
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_results_served_from_cache(self, svc_authorize_mock,
+                                       svc_obj_info_iter_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_results_served_from_cache',
+            'username': 'username',
+            'password': 'password',
+            'gather_subset': 'host,vol',
+            'cache_ttl': 30,
+        })
+        host_ret = [{"id": "1", "name": "ansible_host"}]
+        vol_ret = [{"id": "0", "name": "volume_Ansible_collections"}]
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        svc_obj_info_iter_mock.return_value = [('lshost', host_ret)]
+        with pytest.raises(AnsibleExitJson):
+            v = IBMSVCGatherInfo()
+            v.cache_root = cache_root
+            v.cache_dir = os.path.join(cache_root, 'cluster')
+            v._cache_write({'lsvdisk': vol_ret})
+            v.apply()
+        svc_obj_info_iter_mock.assert_called_once_with(['lshost'])
+
+        svc_obj_info_iter_mock.reset_mock()
+        svc_authorize_mock.reset_mock()
+        with pytest.raises(AnsibleExitJson) as exc:
+            v = IBMSVCGatherInfo()
+            v.cache_root = cache_root
+            v.cache_dir = os.path.join(cache_root, 'cluster')
+            v.apply()
+        svc_obj_info_iter_mock.assert_not_called()
+        # Nothing to fetch, no connection at all
+        svc_authorize_mock.assert_not_called()
+        self.assertEqual(exc.value.args[0]['Hosts'], host_ret)
+        self.assertEqual(exc.value.args[0]['Volumes'], vol_ret)
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_intern_rows(self, svc_authorize_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_intern_rows',
+            'username': 'username',
+            'password': 'password',
+        })
+        # Built at runtime, so that the literals are not shared already
+        rows = [dict(name=''.join(['vol', '0']),
+                     status=''.join(['on', 'line'])) for i in range(2)]
+        IBMSVCGatherInfo()._intern_rows(rows, {})
+        self.assertIs(rows[0]['status'], rows[1]['status'])
+        self.assertIsNot(rows[0]['name'], rows[1]['name'])
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_fields_select_columns(self, svc_authorize_mock,
+                                   svc_obj_info_iter_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_fields_select_columns',
+            'username': 'username',
+            'password': 'password',
+            'gather_subset': 'host,vol',
+            'fields': {'vol': ['id', 'name']},
+        })
+        host_ret = [{"id": "1", "name": "ansible_host", "status": "offline"}]
+        vol_ret = [{"id": "0", "name": "volume_Ansible_collections",
+                    "capacity": "4.00GB", "status": "online"}]
+        svc_obj_info_iter_mock.return_value = [('lshost', host_ret),
+                                               ('lsvdisk', vol_ret)]
+        with pytest.raises(AnsibleExitJson) as exc:
+            IBMSVCGatherInfo().apply()
+        self.assertEqual(exc.value.args[0]['Volumes'],
+                         [{"id": "0", "name": "volume_Ansible_collections"}])
+        self.assertDictEqual(exc.value.args[0]['Hosts'][0], host_ret[0])
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_fields_unknown_subset(self, svc_authorize_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_fields_unknown_subset',
+            'username': 'username',
+            'password': 'password',
+            'fields': {'volume': ['id']},
+        })
+        with pytest.raises(AnsibleFailJson) as exc:
+            IBMSVCGatherInfo()
+        self.assertIn('volume', exc.value.args[0]['msg'])
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_fields_not_a_list(self, svc_authorize_mock):
+        args = {
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_fields_not_a_list',
+            'username': 'username',
+            'password': 'password',
+        }
+        for fields in ({'vol': 'name'}, {'host': [1, 2]}):
+            args['fields'] = fields
+            set_module_args(args)
+            with pytest.raises(AnsibleFailJson) as exc:
+                IBMSVCGatherInfo()
+            self.assertIn(list(fields)[0], exc.value.args[0]['msg'])
+
+    @pytest.mark.skipif(not HAS_ORJSON, reason='orjson is not installed')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_jsonify_with_orjson(self, svc_authorize_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_jsonify_with_orjson',
+            'username': 'username',
+            'password': 'password',
+        })
+        module = IBMSVCGatherInfo().module
+        data = {'Hosts': [{'id': '1', 'name': 'ansible_host'}], 'Pools': []}
+        self.assertEqual(json.loads(module.jsonify(data)), data)
+        self.assertEqual(json.loads(module.jsonify({'set': set(['a'])})),
+                         {'set': ['a']})
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_cache_not_private(self, svc_authorize_mock):
+        set_module_args({
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_cache_not_private',
+            'username': 'username',
+            'password': 'password',
+            'cache_ttl': 30,
+        })
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        v = IBMSVCGatherInfo()
+        v.cache_root = cache_root
+        v.cache_dir = os.path.join(cache_root, 'cluster')
+        v._cache_write({'lsvdisk': []})
+        self.assertEqual(v._cache_read(['lsvdisk']), {'lsvdisk': []})
+
+        os.chmod(v.cache_dir, 0o777)
+        self.assertEqual(v._cache_read(['lsvdisk']), {})
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi.svc_obj_info_iter')
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_cache_write_failures(self, svc_authorize_mock,
+                                  svc_obj_info_iter_mock):
+        args = {
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_cache_write_failures',
+            'username': 'username',
+            'password': 'password',
+            'cache_ttl': -1,
+        }
+        set_module_args(args)
+        with pytest.raises(AnsibleFailJson):
+            IBMSVCGatherInfo()
+
+        args['cache_ttl'] = 30
+        set_module_args(args)
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        v = IBMSVCGatherInfo()
+        v.cache_root = cache_root
+        v.cache_dir = os.path.join(cache_root, 'cluster')
+        self.assertTrue(v._cache_private(create=True))
+        # Listing failed on the storage system
+        svc_obj_info_iter_mock.return_value = [('lshost', None)]
+        with pytest.raises(AnsibleFailJson):
+            v._fetch(['lshost'])
+        self.assertEqual(os.listdir(v.cache_dir), [])
+
+        v._cache_write({'lshost': set()})
+        self.assertEqual(os.listdir(v.cache_dir), [])
+
+    @patch('ansible_collections.ibm.spectrum_virtualize.plugins.module_utils.'
+           'ibm_svc_utils.IBMSVCRestApi._svc_authorize')
+    def test_max_connections(self, svc_authorize_mock):
+        args = {
+            'clustername': 'clustername',
+            'domain': 'domain',
+            'state': 'info',
+            'name': 'test_max_connections',
+            'username': 'username',
+            'password': 'password',
+        }
+        set_module_args(args)
+        self.assertEqual(IBMSVCGatherInfo().restapi.max_connections, 1)
+
+        args['max_connections'] = 2
+        set_module_args(args)
+        self.assertEqual(IBMSVCGatherInfo().restapi.max_connections, 2)
+
+        args['max_connections'] = 0
+        set_module_args(args)
+        with pytest.raises(AnsibleFailJson):
+            IBMSVCGatherInfo()
+
 
 if __name__ == '__main__':
     unittest.main()